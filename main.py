@@ -5,22 +5,29 @@
 #
 
 import json
+import logging
+import orjson
 import os
-import requests
+import random
+import socket
+import sys
 import time
 import urllib3
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
-from io import BytesIO
-from requests import Request, Response, Session
-from requests.auth import AuthBase, HTTPBasicAuth
-from threading import Thread
+from requests import Response, Session, exceptions
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
 from tqdm import tqdm
-from tqdm.utils import CallbackIOWrapper
-from typing import List
-from urllib.parse import urlparse
+from typing import BinaryIO, Callable, Iterator, List
+from urllib3.connection import HTTPConnection
+from urllib3.util import Retry
+
+logger = logging.getLogger("redfish-firmware-update-tool")
 
 
 class ActionStatus(Enum):
@@ -29,184 +36,368 @@ class ActionStatus(Enum):
     Unsupported = 2
 
 
-def refresh_pbar(pbar: tqdm) -> None:
+class FileChunkReader:
+    """
+    Iterates over a file in large chunks and reports the size of each chunk to a callback.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        size: int,
+        callback: Callable[[int], None],
+        chunk_size: int = 1024 * 1024,
+    ) -> None:
+        self.file = file
+        self.size = size
+        self.callback = callback
+        self.chunk_size = chunk_size
+
+    def __len__(self) -> int:
+        # Lets requests send Content-Length instead of a chunked body
+        return self.size
+
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self.file.read(self.chunk_size):
+            self.callback(len(chunk))
+            yield chunk
+
+
+class TunedHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter that enlarges the socket send buffer to keep large firmware uploads
+    flowing at link speed.
+    """
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        # Keep the default options of urllib3, which already include TCP_NODELAY.
+        # The kernel may clamp the send buffer to net.core.wmem_max.
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024),
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def sleep_with_refresh(pbar: tqdm, seconds: float) -> None:
     """
-    Constantly refreshes a given progress bar.
+    Sleeps for given seconds while refreshing a given progress bar at least once a second.
     """
-    while pbar.disable == False:
-        time.sleep(0.5)
+    deadline = time.monotonic() + seconds
+    while (remaining := deadline - time.monotonic()) > 0:
+        time.sleep(min(1, remaining))
         pbar.refresh()
 
 
-def select_multipart_target(members: List[any]) -> List[str]:
+def select_multipart_target(inventories: List[str]) -> List[str]:
     """
     Print and number the available targets on the terminal and ask the user to select the target.
     """
-    print("Available firmware inventories are listed below:")
-    for index, member in enumerate(members, start=1):
-        print(f'{index}\t{member["@odata.id"]}')
+    if len(inventories) == 1:
+        logger.info(f"Only one firmware inventory is available: {inventories[0]}\n")
+        return [inventories[0]]
+
+    sys.stdout.write(
+        "Available firmware inventories are listed below:\n"
+        + "\n".join(
+            f"{index}\t{inventory}"
+            for index, inventory in enumerate(inventories, start=1)
+        )
+        + "\n"
+    )
 
+    valid_indices = range(1, len(inventories) + 1)
     multipart_targets = []
     while True:
-        print("\nPlease enter numbers to select multiple targets, separated by spaces,")
-        print("or 0 to indicate that Multipart HTTP PUSH is not used.")
+        sys.stdout.write(
+            "\nPlease enter numbers to select multiple targets, separated by spaces,\n"
+            "or 0 to indicate that Multipart HTTP PUSH is not used.\n"
+        )
         selection = input(">> ")
 
         if selection == "0":
             break
-        else:
-            indicies = selection.split()
-            for index in indicies:
-                try:
-                    multipart_targets.append(members[int(index) - 1]["@odata.id"])
-                except IndexError:
-                    print(f"Index {index} is not valid.")
-                    multipart_targets.clear()
+
+        try:
+            indices = [int(index) for index in selection.split()]
+        except ValueError:
+            sys.stdout.write("Please enter numbers only.\n")
+            continue
+
+        invalid_indices = [index for index in indices if index not in valid_indices]
+        if len(invalid_indices) > 0:
+            sys.stdout.write(
+                "".join(f"Index {index} is not valid.\n" for index in invalid_indices)
+            )
+            continue
+
+        # Drop duplicated indices while keeping the order of the selection
+        multipart_targets = [inventories[index - 1] for index in dict.fromkeys(indices)]
 
         if len(multipart_targets) != 0:
-            print("\nSelected targets are listed below:")
-            for target in multipart_targets:
-                print(target)
-            print()
+            sys.stdout.write(
+                "\nSelected targets are listed below:\n"
+                + "\n".join(multipart_targets)
+                + "\n\n"
+            )
             break
 
     return multipart_targets
 
 
-def get_from_url(url: str, auth: AuthBase = None) -> Response:
+def resolve_multipart_target(inventories: List[str], targets: List[str]) -> List[str]:
+    """
+    Resolve the targets given on the command line against the available inventories.
+    Returns None if any of the targets is not an available inventory.
+    """
+    if targets == ["auto"]:
+        return inventories
+
+    if targets == ["default"]:
+        return []
+
+    unknown_targets = [target for target in targets if target not in inventories]
+    if len(unknown_targets) > 0:
+        logger.error(
+            "The following targets are not available firmware inventories:\n"
+            + "\n".join(unknown_targets)
+        )
+        return None
+
+    # Drop duplicated targets while keeping the given order
+    return list(dict.fromkeys(targets))
+
+
+def create_session(username: str, password: str) -> Session:
+    """
+    Create a session shared by all HTTP requests sent to the BMC.
+    """
+    adapter = TunedHTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        # Ride out transient network errors and BMC hiccups. Read errors and 5xx
+        # responses are retried on GET requests only, while connection errors are
+        # retried for any method since nothing has been sent yet.
+        # The last 5xx response is returned rather than raised once retries run out.
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        ),
+    )
+
+    session = Session()
+    session.mount("https://", adapter)
+    session.auth = HTTPBasicAuth(username, password)
+    session.verify = False
+
+    return session
+
+
+def get_from_url(
+    session: Session, url: str, quiet: bool = False
+) -> tuple[Response, dict]:
     """
-    Perform a HTTP GET from given URL.
+    Perform a HTTP GET from given URL and decode the JSON data in the response.
+    Errors are not logged if quiet is set, leaving them to the caller.
     """
     response = None
     json_data = None
 
     try:
-        urllib3.disable_warnings()
-        response = requests.get(url=url, auth=auth, verify=False, timeout=3)
-        json_data = response.json()
+        # Pass verify explicitly, otherwise REQUESTS_CA_BUNDLE would override it
+        response = session.get(url=url, verify=session.verify, timeout=3)
+        json_data = orjson.loads(response.content)
     except Exception as e:
-        if json_data is not None:
+        if quiet:
+            pass
+        elif isinstance(e, exceptions.Timeout):
+            logger.error(
+                f"Timed out getting {url}, please check the network and the BMC."
+            )
+        elif isinstance(e, exceptions.ConnectionError):
+            logger.error(
+                f"Cannot connect to {url}, please check the network and the BMC."
+            )
+        elif json_data is not None:
             message = json_data.get("error").get("message")
             if message is not None:
-                print(f"{response.status_code}: {message}")
+                logger.error(f"{response.status_code}: {message}")
             else:
-                print(f"Status Code: {response.status_code}")
-                print(f"Response in JSON:")
-                print(json.dumps(json_data, indent=4))
+                logger.error(
+                    f"Status Code: {response.status_code}\n"
+                    f"Response in JSON:\n{json.dumps(json_data, indent=4)}"
+                )
         elif response is not None:
-            print(f"Status Code: {response.status_code}")
+            logger.error(f"Status Code: {response.status_code}")
         else:
-            print(e)
+            logger.error(e)
 
-    return response
+    return response, json_data
 
 
 def post_firmware(
-    url: str, file_path: str, auth: AuthBase = None
+    session: Session, base_url: str, file_path: str, targets: List[str] = None
 ) -> tuple[ActionStatus, str]:
     """
-    Pushes a firmware file to given URL.
+    Pushes a firmware file to the Update Service of the BMC at given base URL.
+    If targets are not given, the user is asked to select them when Multipart HTTP PUSH is supported.
     """
-    response = get_from_url(url, auth)
+    if not os.path.isfile(file_path):
+        logger.error(f"Cannot find the firmware file: {file_path}")
+        return ActionStatus.Failure, None
+
+    url = f"{base_url}/redfish/v1/UpdateService/"
+    firmware_inventory_url = f"{base_url}/redfish/v1/UpdateService/FirmwareInventory"
+
+    # Get Firmware Inventories along with the Update Service to save a round trip.
+    # They are only used if Multipart HTTP PUSH is supported, so nothing waits for
+    # them otherwise and their errors are left to be reported when they are used.
+    executor = ThreadPoolExecutor(max_workers=2)
+    update_service = executor.submit(get_from_url, session, url)
+    firmware_inventory = executor.submit(
+        get_from_url, session, firmware_inventory_url, quiet=True
+    )
+    executor.shutdown(wait=False)
+
+    response, json_data = update_service.result()
     if response is None or response.status_code != 200:
+        firmware_inventory.cancel()
         return ActionStatus.Failure, None
 
-    multipart_uri = response.json().get("MultipartHttpPushUri")
-    file_size = os.stat(file_path).st_size
-    firmware_file = open(file_path, "rb")
-    prepared_req = None
+    multipart_uri = json_data.get("MultipartHttpPushUri")
+    multipart_targets = []
     task_id = None
 
-    if multipart_uri is not None:
-        print("Update Service on this server supports Multipart HTTP PUSH.")
+    # Targets given on the command line must not be dropped silently
+    explicit_targets = targets is not None and targets != ["default"]
 
-        # Get Firmware Inventories
-        firmware_inventory_url = (
-            urlparse(url)
-            ._replace(path="/redfish/v1/UpdateService/FirmwareInventory")
-            .geturl()
+    if multipart_uri is None:
+        firmware_inventory.cancel()
+
+    if multipart_uri is None and explicit_targets:
+        logger.error(
+            "Update Service on this server does not support Multipart HTTP PUSH, "
+            "the given targets cannot be updated."
         )
-        response = get_from_url(firmware_inventory_url, auth)
+        return ActionStatus.Failure, None
+
+    if multipart_uri is not None:
+        logger.info("Update Service on this server supports Multipart HTTP PUSH.")
+
+        response, json_data = firmware_inventory.result()
 
-        if response.status_code == 200:
-            # Ask the user to select targets
-            multipart_targets = select_multipart_target(response.json().get("Members"))
+        inventories = []
+        if response is not None and response.status_code == 200:
+            # Only the URIs of the inventories are needed
+            members = (json_data or {}).get("Members") or []
+            inventories = [member["@odata.id"] for member in members]
+
+        if len(inventories) == 0:
+            if explicit_targets:
+                logger.error(
+                    "Cannot get firmware inventories from the server, "
+                    "the given targets cannot be updated."
+                )
+                return ActionStatus.Failure, None
+
+            logger.warning(
+                "Cannot get firmware inventories from the server.\n"
+                "Continue to update with default method.\n"
+            )
+        else:
+            if targets is None:
+                # Ask the user to select targets
+                multipart_targets = select_multipart_target(inventories)
+            else:
+                multipart_targets = resolve_multipart_target(inventories, targets)
+                if multipart_targets is None:
+                    return ActionStatus.Failure, None
 
             if len(multipart_targets) > 0:
-                files = {
+                url = f"{base_url}{multipart_uri}"
+            else:
+                logger.info("Continue to update with default method.\n")
+
+    with open(file_path, "rb") as firmware_file:
+        encoder = None
+        file_size = os.path.getsize(file_path)
+
+        if len(multipart_targets) > 0:
+            # The firmware file is read lazily while the body is being sent, and the
+            # length of the body is computed from the parts without serializing it
+            encoder = MultipartEncoder(
+                fields={
                     "UpdateParameters": (
                         None,
-                        json.dumps({"Targets": multipart_targets}),
+                        orjson.dumps({"Targets": multipart_targets}),
                         "application/json",
                     ),
-                    "UpdateFile": (None, firmware_file, "application/octet-stream"),
+                    "UpdateFile": (
+                        os.path.basename(file_path),
+                        firmware_file,
+                        "application/octet-stream",
+                    ),
                 }
-                req = Request(
-                    "post",
-                    url=urlparse(url)._replace(path=multipart_uri).geturl(),
-                    auth=auth,
-                    files=files,
-                )
-                prepared_req = req.prepare()
-                file_size = int(prepared_req.headers.get("Content-Length"))
-            else:
-                print("Continue to update with default method.\n")
-
-    with tqdm(
-        desc="Posting firmware",
-        total=file_size,
-        unit="B",
-        unit_scale=True,
-        unit_divisor=1024,
-        bar_format="Posting firmware  ({percentage:3.0f}%)|{bar:50}{r_bar}",
-    ) as pbar:
-        if prepared_req is None:
-            wrapped_file = CallbackIOWrapper(pbar.update, firmware_file, "read")
-            req = Request("post", url=url, auth=auth, data=wrapped_file)
-            prepared_req = req.prepare()
-        else:
-            body_stream = BytesIO(prepared_req.body)
-            prepared_req.body = CallbackIOWrapper(pbar.update, body_stream, "read")
+            )
+            file_size = encoder.len
 
-        try:
-            s = Session()
-            response = s.send(prepared_req, verify=False)
-            task_id = response.json().get("Id")
-        except Exception as e:
-            print(e)
-            return ActionStatus.Failure, None
+        with tqdm(
+            desc="Posting firmware",
+            total=file_size,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            bar_format="Posting firmware  ({percentage:3.0f}%)|{bar:50}{r_bar}",
+        ) as pbar:
+            if encoder is None:
+                data = FileChunkReader(firmware_file, file_size, pbar.update)
+                headers = None
+            else:
+                data = MultipartEncoderMonitor(
+                    encoder, lambda monitor: pbar.update(monitor.bytes_read - pbar.n)
+                )
+                headers = {"Content-Type": data.content_type}
 
-        pbar.close()
+            try:
+                # Pass verify explicitly, otherwise REQUESTS_CA_BUNDLE would override it
+                response = session.post(
+                    url, data=data, headers=headers, verify=session.verify
+                )
+                task_id = orjson.loads(response.content).get("Id")
+            except Exception as e:
+                logger.error(e)
+                return ActionStatus.Failure, None
 
-    firmware_file.close()
+            pbar.close()
 
     if task_id is None:
-        print("Cannot get the task ID, please check the BMC.")
+        logger.error("Cannot get the task ID, please check the BMC.")
         return ActionStatus.Failure, None
 
-    print(f"Finish posting the firmware! (Task Id = {task_id})")
+    logger.info(f"Finish posting the firmware! (Task Id = {task_id})")
 
     return ActionStatus.Success, task_id
 
 
-def track_update_status(url: str, task_id: str, auth: AuthBase = None) -> ActionStatus:
+def track_update_status(session: Session, url: str, task_id: str) -> ActionStatus:
     """
     Tracks an firmware update task from URL.
     """
-    response = get_from_url(url, auth)
+    response, json_data = get_from_url(session, url)
     if response is None:
         return ActionStatus.Failure
 
-    json_data = response.json()
     if json_data is None:
         return ActionStatus.Failure
 
-    payload = json_data.get("Payload")
-    if (
-        payload.get("HttpOperation") != "POST"
-        or str(payload.get("TargetUri")).find("UpdateService") == -1
+    payload = json_data.get("Payload") or {}
+    target_uri = payload.get("TargetUri") or ""
+    if payload.get("HttpOperation") != "POST" or not target_uri.startswith(
+        "/redfish/v1/UpdateService"
     ):
-        print("This function only supports tracking the status of update tasks.")
+        logger.error("This function only supports tracking the status of update tasks.")
         return ActionStatus.Unsupported
     task_state = json_data.get("TaskState")
     task_status = json_data.get("TaskStatus")
@@ -215,35 +406,51 @@ def track_update_status(url: str, task_id: str, auth: AuthBase = None) -> Action
     exception = None
 
     if task_state == "Running" and task_status == "OK":
-        print(f"Firmware update has started! (Task Id = {task_id})")
+        logger.info(f"Firmware update has started! (Task Id = {task_id})")
 
         with tqdm(
             total=100,
             bar_format="Updating firmware ({percentage:3.0f}%)|{bar:50}| [{elapsed}]",
+            miniters=0,  # redraw on every update of the percentage
         ) as pbar:
-
-            t = Thread(target=refresh_pbar, args=(pbar,), daemon=True)
-            t.start()
-
             time.sleep(1)  # sleep for 1 second before retrieving status
 
+            # Poll quickly at first and back off gradually for long updates
+            base_interval = 0.2
+            max_interval = 10
+            max_error_interval = 60
+            consecutive_polls = 0
+            interval = base_interval
+
             end_time = None
             while end_time is None:
-                response = get_from_url(url, auth)
+                poll_start = time.monotonic()
+                response, json_data = get_from_url(session, url)
                 if response is None:
                     return ActionStatus.Failure
 
-                json_data = response.json()
-                if json_data is None:
-                    exception = Exception(f"Cannot get JSON data in the response!")
-                    break
+                if response.status_code == 200:
+                    if json_data is None:
+                        exception = Exception(f"Cannot get JSON data in the response!")
+                        break
+
+                    task_state = json_data.get("TaskState")
+                    task_status = json_data.get("TaskStatus")
+                    percentage = json_data.get("PercentComplete")
+                    end_time = json_data.get("EndTime")
+
+                    if percentage is not None:
+                        pbar.update(int(percentage) - pbar.n)
 
-                task_state = json_data.get("TaskState")
-                task_status = json_data.get("TaskStatus")
-                percentage = json_data.get("PercentComplete")
-                end_time = json_data.get("EndTime")
+                    interval = min(
+                        max_interval, base_interval * (1.3**consecutive_polls)
+                    )
+                    consecutive_polls += 1
+                else:
+                    # Give the BMC more time to recover when it reports errors
+                    interval = min(max_error_interval, interval * 2)
+                    consecutive_polls = 0
 
-                pbar.n = int(percentage) if percentage is not None else pbar.n
                 delta_time = datetime.now() - start_time
 
                 if end_time is None:
@@ -254,31 +461,40 @@ def track_update_status(url: str, task_id: str, auth: AuthBase = None) -> Action
                             f"This task has taken longer than expected! (Time elapsed: {minutes:02}:{seconds:02})"
                         )
                         break
-                    time.sleep(5)
+                    # Time spent waiting for a slow BMC counts towards the interval,
+                    # and the elapsed time keeps ticking while waiting for next poll
+                    poll_time = time.monotonic() - poll_start
+                    sleep_with_refresh(
+                        pbar, interval + random.uniform(-0.2, 0.2) - poll_time
+                    )
                 else:
                     break
 
-            pbar.close()  # the while loop in refresh_pbar() should be broken
-            t.join()
+            pbar.close()
 
     if task_state == "Completed" and task_status == "OK":
-        print("Firmware update completed!\n")
+        logger.info("Firmware update completed!\n")
         return ActionStatus.Success
 
     if task_state == "Running":
         if exception is not None:
-            print(exception)
+            logger.error(exception)
 
-        print(f"\nException occurs when getting the status of a task (ID: {task_id}).")
-        print(f"Please use other tools to continue tracking the status.\n")
+        logger.error(
+            f"\nException occurs when getting the status of a task (ID: {task_id}).\n"
+            "Please use other tools to continue tracking the status.\n"
+        )
     else:
-        print("Firmware update failed!\n")
-        messages = response.json().get("Messages")
-        if len(messages) > 0:
-            print("Critical messages from the server:")
-            for message in messages:
-                if message.get("Severity") == "Critical":
-                    print(message.get("Message"))
+        logger.error("Firmware update failed!\n")
+        critical_messages = [
+            message.get("Message")
+            for message in json_data.get("Messages") or []
+            if message.get("Severity") == "Critical"
+        ]
+        if len(critical_messages) > 0:
+            logger.error(
+                "Critical messages from the server:\n" + "\n".join(critical_messages)
+            )
 
     return ActionStatus.Failure
 
@@ -329,24 +545,45 @@ def main():
         type=str,
         help="ID of the task to be tracked.",
     )
+    parser.add_argument(
+        "--targets",
+        type=str,
+        nargs="+",
+        help='URIs of the firmware inventories to be updated by Multipart HTTP PUSH, "auto" to select all of them, or "default" to not use Multipart HTTP PUSH. (Prompts for targets if not given)',
+    )
 
     args = parser.parse_args()
+    if args.targets is not None and args.file_path is None:
+        parser.error("argument --targets: only allowed with argument --file-path")
+
+    # Only messages of this tool are printed, not the retry warnings of urllib3
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    # Certificates of BMCs are usually self-signed, so verification is disabled
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     base_url = f"https://{args.bmc_ip}:{args.port}"
-    auth = HTTPBasicAuth(args.username, args.password)
+    session = create_session(args.username, args.password)
+
+    task_id = args.task_id
 
     if args.file_path:
-        url = urlparse(base_url)._replace(path="/redfish/v1/UpdateService/").geturl()
-        status, task_id = post_firmware(url, args.file_path, auth)
+        status, task_id = post_firmware(session, base_url, args.file_path, args.targets)
+        if status != ActionStatus.Success:
+            sys.exit(1)
 
-    task_id = args.task_id if args.task_id is not None else task_id
+    if task_id is None:
+        logger.error("There is no task ID to be tracked.")
+        sys.exit(1)
 
-    url = (
-        urlparse(base_url)
-        ._replace(path=f"/redfish/v1/TaskService/Tasks/{task_id}")
-        .geturl()
-    )
-    status = track_update_status(url, task_id, auth)
+    url = f"{base_url}/redfish/v1/TaskService/Tasks/{task_id}"
+    status = track_update_status(session, url, task_id)
+    if status != ActionStatus.Success:
+        sys.exit(1)
 
 
 if __name__ == "__main__":